@@ -6,23 +6,90 @@
 @software: PyCharm
 @time: 18-12-25 下午5:15
 """
+import asyncio
 import atexit
+import os
 import secrets
-import ujson
-import uuid
-from collections import MutableMapping
+import time
+import weakref
+from collections.abc import MutableMapping
+from functools import lru_cache
 
 import aelog
 import aredis
-from aredis import RedisError
+from aredis import ConnectionError, RedisError
 
 from .exceptions import RedisClientError
 from .utils import ignore_error
 
+try:
+    import orjson
+
+    _loads = orjson.loads
+    # 写入redis的场景直接交bytes给客户端编码,省去一次decode/encode往返
+    _dumps_bytes = orjson.dumps
+except ImportError:
+    import ujson
+
+    _loads = ujson.loads
+    _dumps_bytes = ujson.dumps
+
 __all__ = ("Session", "AIORedisClient")
 
 EXPIRED = 24 * 60 * 60
 
+# 每个task复用的pipeline对象, task -> {factory: pipeline}, task结束后弱引用自动清理
+_task_pipes = weakref.WeakKeyDictionary()
+
+
+@lru_cache(maxsize=1024)
+def _pack_exists(name):
+    """
+    预打包EXISTS命令的RESP字节串,跳过客户端通用的参数编码
+    Args:
+        name: redis key的名称
+    Returns:
+
+    """
+    name = name.encode() if name.__class__ is str else name
+    return b"*2\r\n$6\r\nEXISTS\r\n$" + str(len(name)).encode() + b"\r\n" + name + b"\r\n"
+
+
+@lru_cache(maxsize=1024)
+def _pack_del(name):
+    """
+    预打包单个key的DEL命令的RESP字节串,跳过客户端通用的参数编码
+    Args:
+        name: redis key的名称
+    Returns:
+
+    """
+    name = name.encode() if name.__class__ is str else name
+    return b"*2\r\n$3\r\nDEL\r\n$" + str(len(name)).encode() + b"\r\n" + name + b"\r\n"
+
+
+def _encode(val):
+    """
+    序列化非字符串的值,字符串原样返回
+    Args:
+        val: 要保存的值
+    Returns:
+
+    """
+    return val if type(val) is str else _dumps_bytes(val)
+
+
+def _raise(msg_tmpl, **kwargs):
+    """
+    延迟错误信息的格式化,只有真正抛错时才执行.format调用
+    Args:
+        msg_tmpl: 错误信息模板
+        kwargs: 模板参数
+    Returns:
+
+    """
+    raise RedisClientError(msg_tmpl.format(**kwargs))
+
 
 class Session(object):
     """
@@ -34,13 +101,15 @@ class Session(object):
     def __init__(self, account_id, *, org_id=None, role_id=None, permission_id=None, **kwargs):
         self.account_id = account_id  # 账户ID
         self.session_id = secrets.token_urlsafe()  # session ID
-        self.org_id = org_id or uuid.uuid4().hex  # 账户的组织结构在redis中的ID
-        self.role_id = role_id or uuid.uuid4().hex  # 账户的角色在redis中的ID
-        self.permission_id = permission_id or uuid.uuid4().hex  # 账户的权限在redis中的ID
-        self.static_permission_id = uuid.uuid4().hex  # 账户的静态权限在redis中的ID
-        self.dynamic_permission_id = uuid.uuid4().hex  # 账户的动态权限在redis中的ID
-        self.page_id = uuid.uuid4().hex  # 账户的页面权限在redis中的ID
-        self.page_menu_id = uuid.uuid4().hex  # 账户的页面菜单权限在redis中的ID
+        # 一次取足随机字节再切片生成各个ID,与逐个uuid.uuid4().hex等价但只需一次系统调用
+        raw = os.urandom(112)
+        self.org_id = org_id or raw[:16].hex()  # 账户的组织结构在redis中的ID
+        self.role_id = role_id or raw[16:32].hex()  # 账户的角色在redis中的ID
+        self.permission_id = permission_id or raw[32:48].hex()  # 账户的权限在redis中的ID
+        self.static_permission_id = raw[48:64].hex()  # 账户的静态权限在redis中的ID
+        self.dynamic_permission_id = raw[64:80].hex()  # 账户的动态权限在redis中的ID
+        self.page_id = raw[80:96].hex()  # 账户的页面权限在redis中的ID
+        self.page_menu_id = raw[96:112].hex()  # 账户的页面菜单权限在redis中的ID
         for k, v in kwargs.items():
             setattr(self, k, v)
 
@@ -50,7 +119,16 @@ class AIORedisClient(object):
     redis 非阻塞工具类
     """
 
-    def __init__(self, app=None, *, host="127.0.0.1", port=6379, dbname=0, passwd="", pool_size=50):
+    # 写入和读取的lua脚本,命令与过期时间在服务端一次原子完成,EVALSHA只需一次网络的往返
+    _HSET_EXPIRE_LUA = ("redis.call('HSET', KEYS[1], unpack(ARGV, 2)) "
+                        "return redis.call('EXPIRE', KEYS[1], ARGV[1])")
+    _HGETALL_TOUCH_LUA = ("local data = redis.call('HGETALL', KEYS[1]) "
+                          "if #data > 0 then redis.call('EXPIRE', KEYS[1], ARGV[1]) end "
+                          "return data")
+    _CHECK_DEL_LUA = ("if redis.call('HGET', KEYS[1], 'session_id') == KEYS[1] "
+                      "then return redis.call('DEL', KEYS[1]) else return -1 end")
+
+    def __init__(self, app=None, *, host="127.0.0.1", port=6379, dbname=0, passwd="", pool_size=50, verify_ttl=5):
         """
         redis 非阻塞工具类
         Args:
@@ -60,9 +138,40 @@ class AIORedisClient(object):
             dbname: database name
             passwd: redis password
             pool_size: redis pool size
+            verify_ttl: verify进程内缓存的有效时间，单位秒
         """
         self.pool = None
         self.redis_db = None
+        # 按工作负载拆分的连接池和client: session校验 / 普通键值 / 列表
+        self._session_pool = None
+        self._kv_pool = None
+        self._list_pool = None
+        self._session_db = None
+        self._kv_db = None
+        self._list_db = None
+        # 缓存的redis命令的bound method,减少热路径上的属性查找
+        self._pipeline = None
+        self._kv_pipeline = None
+        self._list_pipeline = None
+        self._set = None
+        self._get = None
+        self._hget = None
+        self._hgetall = None
+        self._kv_hgetall = None
+        self._lrange = None
+        self._delete = None
+        self._scan = None
+        # 注册到服务端的lua脚本
+        self._hset_expire_script = None
+        self._hgetall_touch_script = None
+        self._check_del_script = None
+        # 记录每个key最近一次刷新过期时间的时刻,用于跳过不必要的EXPIRE
+        self._last_touch = {}
+        # verify的进程内短TTL正向缓存, session_id -> (缓存时刻, Session实例)
+        self._verify_cache = {}
+        self.verify_ttl = verify_ttl
+        # 是否在同一task内复用pipeline对象,默认关闭,确认aredis的reset语义后可打开
+        self.reuse_pipelines = False
         self.host = host
         self.port = port
         self.dbname = dbname
@@ -73,7 +182,119 @@ class AIORedisClient(object):
             self.init_app(app, host=self.host, port=self.port, dbname=self.dbname, passwd=self.passwd,
                           pool_size=self.pool_size)
 
-    def init_app(self, app, *, host=None, port=None, dbname=None, passwd="", pool_size=None):
+    def _open_pools(self, host, port, dbname, passwd, pool_size):
+        """
+        按工作负载创建独立的连接池,阻塞的列表操作不会再挤占session校验的连接
+        Args:
+            host:redis host
+            port:redis port
+            dbname: database name
+            passwd: redis password
+            pool_size: redis pool size
+        Returns:
+
+        """
+        # 返回值都做了解码，应用层不需要再decode
+        self._session_pool = aredis.ConnectionPool(host=host, port=port, db=dbname, password=passwd,
+                                                   decode_responses=True, max_connections=max(8, pool_size // 2))
+        self._kv_pool = aredis.ConnectionPool(host=host, port=port, db=dbname, password=passwd,
+                                              decode_responses=True, max_connections=max(4, pool_size // 4))
+        self._list_pool = aredis.ConnectionPool(host=host, port=port, db=dbname, password=passwd,
+                                                decode_responses=True, max_connections=max(4, pool_size // 4))
+        self._session_db = aredis.StrictRedis(connection_pool=self._session_pool, decode_responses=True)
+        self._kv_db = aredis.StrictRedis(connection_pool=self._kv_pool, decode_responses=True)
+        self._list_db = aredis.StrictRedis(connection_pool=self._list_pool, decode_responses=True)
+        # 保持原有的对外属性,默认指向session的连接
+        self.pool = self._session_pool
+        self.redis_db = self._session_db
+        self._cache_commands()
+
+    def _close_pools(self):
+        """
+        释放所有连接池的连接
+        Args:
+
+        Returns:
+
+        """
+        self.redis_db = None
+        self._session_db = self._kv_db = self._list_db = None
+        for pool in (self._session_pool, self._kv_pool, self._list_pool):
+            if pool:
+                pool.disconnect()
+
+    def _cache_commands(self):
+        """
+        缓存常用redis命令的bound method,省去每次调用时self和redis_db上的两级属性查找
+        Args:
+
+        Returns:
+
+        """
+        # session相关的命令走低延迟的session连接池
+        self._pipeline = self._session_db.pipeline
+        self._hgetall = self._session_db.hgetall
+        self._hset_expire_script = self._session_db.register_script(self._HSET_EXPIRE_LUA)
+        self._hgetall_touch_script = self._session_db.register_script(self._HGETALL_TOUCH_LUA)
+        self._check_del_script = self._session_db.register_script(self._CHECK_DEL_LUA)
+        # 普通键值相关的命令
+        self._kv_pipeline = self._kv_db.pipeline
+        self._set = self._kv_db.set
+        self._get = self._kv_db.get
+        self._hget = self._kv_db.hget
+        self._kv_hgetall = self._kv_db.hgetall
+        self._delete = self._kv_db.delete
+        self._scan = self._kv_db.scan
+        # 列表相关的命令
+        self._list_pipeline = self._list_db.pipeline
+        self._lrange = self._list_db.lrange
+
+    async def _get_pipe(self, factory):
+        """
+        获取pipeline对象, 打开reuse_pipelines后在同一task内复用
+
+        复用的映射以当前task为键,并发的task各有自己的pipeline,不会互相交错命令队列;
+        pipeline在execute后会reset命令队列,同一task内的顺序调用复用是安全的,
+        省去每次调用的Pipeline实例和命令队列分配
+        Args:
+            factory: 对应连接池client的pipeline工厂方法
+        Returns:
+            pipeline对象
+        """
+        if not self.reuse_pipelines:
+            return await factory(transaction=False)
+        task = asyncio.current_task()
+        if task is None:
+            return await factory(transaction=False)
+        pipes = _task_pipes.get(task)
+        if pipes is None:
+            pipes = _task_pipes[task] = {}
+        pipe = pipes.get(factory)
+        if pipe is None:
+            pipe = pipes[factory] = await factory(transaction=False)
+        return pipe
+
+    def _need_touch(self, name, ex):
+        """
+        判断读取时是否需要刷新key的过期时间
+
+        最近刚刷新过的key在过期时间的十分之一内不再重复发送EXPIRE,减少发送的命令数
+        Args:
+            name: redis key的名称
+            ex: 过期时间，单位秒
+        Returns:
+            是否需要刷新过期时间
+        """
+        now = time.monotonic()
+        last = self._last_touch.get(name)
+        if last is not None and now - last < ex // 10:
+            return False
+        if len(self._last_touch) > 100000:  # 防止记录无限增长
+            self._last_touch.clear()
+        self._last_touch[name] = now
+        return True
+
+    def init_app(self, app, *, host=None, port=None, dbname=None, passwd="", pool_size=None, verify_ttl=None):
         """
         redis 非阻塞工具类
         Args:
@@ -83,6 +304,7 @@ class AIORedisClient(object):
             dbname: database name
             passwd: redis password
             pool_size: redis pool size
+            verify_ttl: verify进程内缓存的有效时间，单位秒
         Returns:
 
         """
@@ -91,6 +313,7 @@ class AIORedisClient(object):
         dbname = dbname or app.config.get("ACLIENTS_REDIS_DBNAME", None) or self.dbname
         passwd = passwd or app.config.get("ACLIENTS_REDIS_PASSWD", None) or self.passwd
         pool_size = pool_size or app.config.get("ACLIENTS_REDIS_POOL_SIZE", None) or self.pool_size
+        self.verify_ttl = verify_ttl or app.config.get("ACLIENTS_REDIS_VERIFY_TTL", None) or self.verify_ttl
 
         passwd = passwd if passwd is None else str(passwd)
 
@@ -103,10 +326,7 @@ class AIORedisClient(object):
             Returns:
 
             """
-            # 返回值都做了解码，应用层不需要再decode
-            self.pool = aredis.ConnectionPool(host=host, port=port, db=dbname, password=passwd, decode_responses=True,
-                                              max_connections=pool_size)
-            self.redis_db = aredis.StrictRedis(connection_pool=self.pool, decode_responses=True)
+            self._open_pools(host, port, dbname, passwd, pool_size)
 
         @app.listener('after_server_stop')
         async def close_connection(app_, loop):
@@ -117,9 +337,7 @@ class AIORedisClient(object):
             Returns:
 
             """
-            self.redis_db = None
-            if self.pool:
-                self.pool.disconnect()
+            self._close_pools()
 
     def init_engine(self, *, host=None, port=None, dbname=None, passwd="", pool_size=None):
         """
@@ -140,10 +358,7 @@ class AIORedisClient(object):
         pool_size = pool_size or self.pool_size
 
         passwd = passwd if passwd is None else str(passwd)
-        # 返回值都做了解码，应用层不需要再decode
-        self.pool = aredis.ConnectionPool(host=host, port=port, db=dbname, password=passwd, decode_responses=True,
-                                          max_connections=pool_size)
-        self.redis_db = aredis.StrictRedis(connection_pool=self.pool, decode_responses=True)
+        self._open_pools(host, port, dbname, passwd, pool_size)
 
         @atexit.register
         def close_connection():
@@ -154,9 +369,41 @@ class AIORedisClient(object):
             Returns:
 
             """
-            self.redis_db = None
-            if self.pool:
-                self.pool.disconnect()
+            self._close_pools()
+
+    @staticmethod
+    def _session_data(session, dump_responses):
+        """
+        由Session实例构造要保存的hash mapping
+        Args:
+            session: Session 实例
+            dump_responses: 是否对每个键值进行dump
+        Returns:
+            hash mapping
+        """
+        # 常规路径为C层的纯字典拷贝; 保存时重新检查一遍值的类型,含非字符串值时才批量编码
+        session_data = dict(session.__dict__)
+        if dump_responses and any(type(hash_val) is not str for hash_val in session_data.values()):
+            session_data = dict(zip(session_data.keys(), map(_encode, session_data.values())))
+        return session_data
+
+    async def _hset_expire(self, name, mapping, ex, db=None):
+        """
+        通过lua脚本把hset和expire作为一次原子操作在服务端完成
+
+        使用变参的HSET代替redis 4.0起废弃的HMSET, 写入与过期时间之间不会再出现遗留永久key的窗口
+        Args:
+            name: redis hash key的名称
+            mapping: 保存的hash mapping
+            ex: 过期时间，单位秒
+        Returns:
+            expire结果
+        """
+        args = [ex]
+        for hash_key, hash_val in mapping.items():
+            args.append(hash_key)
+            args.append(hash_val)
+        return await self._hset_expire_script.execute(keys=[name], args=args, client=db)
 
     async def save_session(self, session: Session, dump_responses=False, ex=EXPIRED):
         """
@@ -168,28 +415,48 @@ class AIORedisClient(object):
         Returns:
 
         """
-        session_data = dict(vars(session))
-        # 是否对每个键值进行dump
-        if dump_responses:
-            hash_data = {}
-            for hash_key, hash_val in session_data.items():
-                if not isinstance(hash_val, str):
-                    with ignore_error():
-                        hash_val = ujson.dumps(hash_val)
-                hash_data[hash_key] = hash_val
-            session_data = hash_data
+        session_data = self._session_data(session, dump_responses)
 
         try:
-            if not await self.redis_db.hmset(session_data["session_id"], session_data):
-                raise RedisClientError("save session failed, session_id={}".format(session_data["session_id"]))
-            if not await self.redis_db.expire(session_data["session_id"], ex):
-                raise RedisClientError("set session expire failed, session_id={}".format(session_data["session_id"]))
+            expire_rs = await self._hset_expire(session_data["session_id"], session_data, ex)
+            if not expire_rs:
+                _raise("set session expire failed, session_id={sid}", sid=session_data["session_id"])
         except RedisError as e:
             aelog.exception("save session error: {}, {}".format(session.session_id, e))
             raise RedisClientError(str(e))
         else:
             return session.session_id
 
+    async def save_sessions_bulk(self, sessions, dump_responses=False, ex=EXPIRED):
+        """
+        利用pipeline批量保存session,所有写入只需一次网络的往返
+        Args:
+            sessions: Session实例的列表
+            dump_responses: 是否对每个键值进行dump
+            ex: 过期时间，单位秒
+        Returns:
+            session id的列表
+        """
+        pipe = await self._get_pipe(self._pipeline)
+        session_ids = []
+        for session in sessions:
+            session_data = self._session_data(session, dump_responses)
+            items = []
+            for hash_key, hash_val in session_data.items():
+                items.append(hash_key)
+                items.append(hash_val)
+            await pipe.execute_command("HSET", session_data["session_id"], *items)
+            await pipe.expire(session_data["session_id"], ex)
+            session_ids.append(session_data["session_id"])
+
+        try:
+            await pipe.execute()
+        except RedisError as e:
+            aelog.exception("save sessions bulk error: {}".format(e))
+            raise RedisClientError(str(e))
+        else:
+            return session_ids
+
     async def delete_session(self, session_id):
         """
         利用hash map删除session
@@ -199,13 +466,15 @@ class AIORedisClient(object):
 
         """
 
+        self._verify_cache.pop(session_id, None)
         try:
-            session_id_ = await self.redis_db.hget(session_id, "session_id")
-            if session_id_ != session_id:
-                raise RedisClientError("invalid session_id, session_id={}".format(session_id))
+            # lua脚本在服务端原子地校验session_id字段并删除,不匹配时返回-1
+            delete_rs = await self._check_del_script.execute(keys=[session_id])
+            if delete_rs == -1:
+                _raise("invalid session_id, session_id={sid}", sid=session_id)
 
-            if not await self.redis_db.delete(session_id):
-                raise RedisClientError("delete session failed, session_id={}".format(session_id))
+            if not delete_rs:
+                _raise("delete session failed, session_id={sid}", sid=session_id)
         except RedisError as e:
             aelog.exception("delete session error: {}, {}".format(session_id, e))
             raise RedisClientError(str(e))
@@ -220,26 +489,40 @@ class AIORedisClient(object):
         Returns:
 
         """
-        session_data = dict(vars(session))
-        # 是否对每个键值进行dump
-        if dump_responses:
-            hash_data = {}
-            for hash_key, hash_val in session_data.items():
-                if not isinstance(hash_val, str):
-                    with ignore_error():
-                        hash_val = ujson.dumps(hash_val)
-                hash_data[hash_key] = hash_val
-            session_data = hash_data
+        session_data = self._session_data(session, dump_responses)
+        self._verify_cache.pop(session_data["session_id"], None)
 
         try:
-            if not await self.redis_db.hmset(session_data["session_id"], session_data):
-                raise RedisClientError("update session failed, session_id={}".format(session_data["session_id"]))
-            if not await self.redis_db.expire(session_data["session_id"], ex):
-                raise RedisClientError("set session expire failed, session_id={}".format(session_data["session_id"]))
+            expire_rs = await self._hset_expire(session_data["session_id"], session_data, ex)
+            if not expire_rs:
+                _raise("set session expire failed, session_id={sid}", sid=session_data["session_id"])
         except RedisError as e:
             aelog.exception("update session error: {}, {}".format(session_data["session_id"], e))
             raise RedisClientError(str(e))
 
+    @staticmethod
+    def _make_session(session_data, load_responses):
+        """
+        由读取到的hash mapping直接构造Session实例
+
+        直接填充__dict__, 一次遍历即完成load和实例构造,跳过__init__中逐字段的setattr
+        Args:
+            session_data: 读取到的hash mapping
+            load_responses: 结果的键值是否进行load
+        Returns:
+            Session实例
+        """
+        session = Session.__new__(Session)
+        session_dict = session.__dict__
+        if load_responses:
+            for hash_key, hash_val in session_data.items():
+                with ignore_error():
+                    hash_val = _loads(hash_val)
+                session_dict[hash_key] = hash_val
+        else:
+            session_dict.update(session_data)
+        return session
+
     async def get_session(self, session_id, ex=EXPIRED, cls_flag=True, load_responses=False) -> Session:
         """
         获取session
@@ -253,32 +536,55 @@ class AIORedisClient(object):
         """
 
         try:
-            session_data = await self.redis_db.hgetall(session_id)
+            if self._need_touch(session_id, ex):
+                # lua脚本返回的是扁平的键值列表,读取和续期在服务端一次原子完成
+                flat_data = await self._hgetall_touch_script.execute(keys=[session_id], args=[ex])
+                session_data = dict(zip(flat_data[::2], flat_data[1::2]))
+            else:
+                session_data = await self._hgetall(session_id)
             if not session_data:
-                raise RedisClientError("not found session, session_id={}".format(session_id))
-
-            if not await self.redis_db.expire(session_id, ex):
-                raise RedisClientError("set session expire failed, session_id={}".format(session_id))
+                _raise("not found session, session_id={sid}", sid=session_id)
         except RedisError as e:
             aelog.exception("get session error: {}, {}".format(session_id, e))
             raise RedisClientError(e)
         else:
-            # 返回的键值对是否做load
-            if load_responses:
-                hash_data = {}
-                for hash_key, hash_val in session_data.items():
-                    with ignore_error():
-                        hash_val = ujson.loads(hash_val)
-                    hash_data[hash_key] = hash_val
-                session_data = hash_data
-
             if cls_flag:
-                return Session(account_id=session_data.pop('account_id'), org_id=session_data.pop("org_id"),
-                               role_id=session_data.pop("role_id"), permission_id=session_data.pop("permission_id"),
-                               **session_data)
+                return self._make_session(session_data, load_responses)
             else:
+                # 返回的键值对是否做load
+                if load_responses:
+                    hash_data = {}
+                    for hash_key, hash_val in session_data.items():
+                        with ignore_error():
+                            hash_val = _loads(hash_val)
+                        hash_data[hash_key] = hash_val
+                    session_data = hash_data
                 return session_data
 
+    async def get_sessions(self, session_ids, ex=EXPIRED, load_responses=False):
+        """
+        利用pipeline批量获取session,所有读取和续期只需一次网络的往返
+        Args:
+            session_ids: session id的列表
+            ex: 过期时间，单位秒
+            load_responses: 结果的键值是否进行load
+        Returns:
+            与session_ids顺序对应的Session实例列表,不存在的session为None
+        """
+        pipe = await self._get_pipe(self._pipeline)
+        for session_id in session_ids:
+            await pipe.hgetall(session_id)
+            await pipe.expire(session_id, ex)
+
+        try:
+            raw_data = await pipe.execute()
+        except RedisError as e:
+            aelog.exception("get sessions error: {}".format(e))
+            raise RedisClientError(str(e))
+        else:
+            return [self._make_session(session_data, load_responses) if session_data else None
+                    for session_data in raw_data[::2]]
+
     async def verify(self, session_id):
         """
         校验session，主要用于登录校验
@@ -287,13 +593,22 @@ class AIORedisClient(object):
         Returns:
 
         """
+        # 命中进程内的短TTL缓存时直接返回,热门session的校验完全不走redis
+        now = time.monotonic()
+        cached = self._verify_cache.get(session_id)
+        if cached is not None and now - cached[0] < self.verify_ttl:
+            return cached[1]
+
         try:
             session = await self.get_session(session_id)
         except RedisClientError as e:
             raise RedisClientError(str(e))
         else:
             if not session:
-                raise RedisClientError("invalid session_id, session_id={}".format(session_id))
+                _raise("invalid session_id, session_id={sid}", sid=session_id)
+            if len(self._verify_cache) > 10000:  # 防止缓存无限增长
+                self._verify_cache.clear()
+            self._verify_cache[session_id] = (now, session)
             return session
 
     async def save_update_hash_data(self, name, hash_data: dict, field_name=None, ex=EXPIRED, dump_responses=False):
@@ -308,7 +623,8 @@ class AIORedisClient(object):
         Returns:
             反序列化对象
         """
-        if not isinstance(hash_data, MutableMapping):
+        # 绝大多数调用传入的都是dict,先做直接的类型判断,避免走ABC较慢的__instancecheck__
+        if type(hash_data) is not dict and not isinstance(hash_data, MutableMapping):
             raise ValueError("hash data error, must be MutableMapping.")
 
         try:
@@ -317,20 +633,22 @@ class AIORedisClient(object):
                 if dump_responses:
                     rs_data = {}
                     for hash_key, hash_val in hash_data.items():
-                        if not isinstance(hash_val, str):
+                        if hash_val.__class__ is not str:
                             with ignore_error():
-                                hash_val = ujson.dumps(hash_val)
+                                hash_val = _dumps_bytes(hash_val)
                         rs_data[hash_key] = hash_val
                     hash_data = rs_data
 
-                if not await self.redis_db.hmset(name, hash_data):
-                    raise RedisClientError("save hash data mapping failed, session_id={}".format(name))
+                expire_rs = await self._hset_expire(name, hash_data, ex, db=self._kv_db)
             else:
-                hash_data = hash_data if isinstance(hash_data, str) else ujson.dumps(hash_data)
-                await self.redis_db.hset(name, field_name, hash_data)
-
-            if not await self.redis_db.expire(name, ex):
-                raise RedisClientError("set hash data expire failed, session_id={}".format(name))
+                hash_data = hash_data if hash_data.__class__ is str else _dumps_bytes(hash_data)
+                pipe = await self._get_pipe(self._kv_pipeline)
+                await pipe.hset(name, field_name, hash_data)
+                await pipe.expire(name, ex)
+                _, expire_rs = await pipe.execute()
+
+            if not expire_rs:
+                _raise("set hash data expire failed, session_id={name}", name=name)
         except RedisError as e:
             raise RedisClientError(str(e))
         else:
@@ -348,27 +666,40 @@ class AIORedisClient(object):
             反序列化对象
         """
         try:
+            if self._need_touch(name, ex):
+                if field_name:
+                    pipe = await self._get_pipe(self._kv_pipeline)
+                    await pipe.hget(name, field_name)
+                    await pipe.expire(name, ex)
+                    hash_data, expire_rs = await pipe.execute()
+                else:
+                    flat_data = await self._hgetall_touch_script.execute(keys=[name], args=[ex],
+                                                                          client=self._kv_db)
+                    hash_data, expire_rs = dict(zip(flat_data[::2], flat_data[1::2])), True
+            else:
+                hash_data = await (self._hget(name, field_name) if field_name else self._kv_hgetall(name))
+                expire_rs = True
+
             if field_name:
-                hash_data = await self.redis_db.hget(name, field_name)
                 # 返回的键值对是否做load
                 if load_responses:
                     with ignore_error():
-                        hash_data = ujson.loads(hash_data)
+                        hash_data = _loads(hash_data)
             else:
-                hash_data = await self.redis_db.hgetall(name)
                 # 返回的键值对是否做load
                 if load_responses:
                     rs_data = {}
                     for hash_key, hash_val in hash_data.items():
                         with ignore_error():
-                            hash_val = ujson.loads(hash_val)
+                            hash_val = _loads(hash_val)
                         rs_data[hash_key] = hash_val
                     hash_data = rs_data
             if not hash_data:
-                raise RedisClientError("not found hash data, name={}, field_name={}".format(name, field_name))
+                _raise("not found hash data, name={name}, field_name={field_name}", name=name,
+                       field_name=field_name)
 
-            if not await self.redis_db.expire(name, ex):
-                raise RedisClientError("set expire failed, name={}".format(name))
+            if not expire_rs:
+                _raise("set expire failed, name={name}", name=name)
         except RedisError as e:
             raise RedisClientError(str(e))
         else:
@@ -386,12 +717,19 @@ class AIORedisClient(object):
 
         """
         try:
-            data = await self.redis_db.lrange(name, start=start, end=end)
+            if self._need_touch(name, ex):
+                pipe = await self._get_pipe(self._list_pipeline)
+                await pipe.lrange(name, start=start, end=end)
+                await pipe.expire(name, ex)
+                data, expire_rs = await pipe.execute()
+            else:
+                data, expire_rs = await self._lrange(name, start=start, end=end), True
             if not data:
-                raise RedisClientError("not found list data, name={}, start={}, end={}".format(name, start, end))
+                _raise("not found list data, name={name}, start={start}, end={end}", name=name, start=start,
+                       end=end)
 
-            if not await self.redis_db.expire(name, ex):
-                raise RedisClientError("set expire failed, name={}".format(name))
+            if not expire_rs:
+                _raise("set expire failed, name={name}", name=name)
         except RedisError as e:
             raise RedisClientError(str(e))
         else:
@@ -408,16 +746,19 @@ class AIORedisClient(object):
         Returns:
 
         """
-        list_data = (list_data,) if isinstance(list_data, str) else list_data
+        list_data = (list_data,) if list_data.__class__ is str else list_data
         try:
+            pipe = await self._get_pipe(self._list_pipeline)
             if save_to_left:
-                if not await self.redis_db.lpush(name, *list_data):
-                    raise RedisClientError("lpush value to head failed.")
+                await pipe.lpush(name, *list_data)
             else:
-                if not await self.redis_db.rpush(name, *list_data):
-                    raise RedisClientError("lpush value to tail failed.")
-            if not await self.redis_db.expire(name, ex):
-                raise RedisClientError("set expire failed, name={}".format(name))
+                await pipe.rpush(name, *list_data)
+            await pipe.expire(name, ex)
+            push_rs, expire_rs = await pipe.execute()
+            if not push_rs:
+                raise RedisClientError("lpush value to head failed." if save_to_left else "lpush value to tail failed.")
+            if not expire_rs:
+                _raise("set expire failed, name={name}", name=name)
         except RedisError as e:
             raise RedisClientError(str(e))
         else:
@@ -433,9 +774,9 @@ class AIORedisClient(object):
         Returns:
 
         """
-        value = ujson.dumps(value) if not isinstance(value, str) else value
+        value = value if value.__class__ is str else _dumps_bytes(value)
         try:
-            if not await self.redis_db.set(name, value, ex):
+            if not await self._set(name, value, ex):
                 raise RedisClientError("set serializable value failed!")
         except RedisError as e:
             raise RedisClientError(str(e))
@@ -452,20 +793,65 @@ class AIORedisClient(object):
             反序列化对象
         """
         try:
-            data = await self.redis_db.get(name)
+            # GETEX一条命令完成读取和刷新过期时间, 需要redis 6.2+
+            if self._need_touch(name, ex):
+                data = await self._kv_db.execute_command("GETEX", name, "EX", ex)
+            else:
+                data = await self._get(name)
             if not data:
-                raise RedisClientError("not found usual data, name={}".format(name))
-
-            if not await self.redis_db.expire(name, ex):
-                raise RedisClientError("set expire failed, name={}".format(name))
+                _raise("not found usual data, name={name}", name=name)
 
         except RedisError as e:
             raise RedisClientError(str(e))
         else:
-            with ignore_error():
-                data = ujson.loads(data)
+            # 首字符明显不是JSON的普通字符串直接返回,省去一次注定失败的parse和异常分配
+            if data[0] in '{["tfn-0123456789':
+                with ignore_error():
+                    data = _loads(data)
             return data
 
+    @staticmethod
+    async def _send_packed_once(conn, packed):
+        """
+        在指定连接上发送预打包的RESP命令并读取结果
+
+        任何失败都主动断开连接,避免把带着未读回复的连接放回连接池
+        Args:
+            conn: redis连接
+            packed: 打包好的RESP命令字节串
+        Returns:
+            命令的执行结果
+        """
+        try:
+            # 负载必须以列表传入,裸bytes会被send_packed_command逐字节迭代
+            await conn.send_packed_command([packed])
+            # send_packed_command不会像send_command一样标记等待中的回复,这里补上
+            conn.awaiting_response = True
+            return await conn.read_response()
+        except BaseException:
+            conn.disconnect()
+            raise
+
+    async def _send_packed(self, packed):
+        """
+        直接发送预打包的RESP命令并读取结果,绕开每次调用的命令编码
+
+        与execute_command的语义保持一致,连接错误时断开重连并重试一次
+        Args:
+            packed: 打包好的RESP命令字节串
+        Returns:
+            命令的执行结果
+        """
+        pool = self._kv_db.connection_pool
+        conn = pool.get_connection()
+        try:
+            try:
+                return await self._send_packed_once(conn, packed)
+            except ConnectionError:
+                return await self._send_packed_once(conn, packed)
+        finally:
+            pool.release(conn)
+
     async def is_exist_key(self, name):
         """
         判断redis key是否存在
@@ -475,11 +861,11 @@ class AIORedisClient(object):
 
         """
         try:
-            data = await self.redis_db.exists(name)
+            data = await self._send_packed(_pack_exists(name))
         except RedisError as e:
             raise RedisClientError(str(e))
         else:
-            return data
+            return bool(data)
 
     async def delete_keys(self, names: list):
         """
@@ -489,23 +875,35 @@ class AIORedisClient(object):
         Returns:
 
         """
-        names = (names,) if isinstance(names, str) else names
+        names = (names,) if names.__class__ is str else names
         try:
-            if not await self.redis_db.delete(*names):
-                raise RedisClientError("Delete redis keys failed {}.".format(*names))
+            if len(names) == 1:
+                delete_rs = await self._send_packed(_pack_del(names[0]))
+            else:
+                delete_rs = await self._delete(*names)
+            if not delete_rs:
+                _raise("Delete redis keys failed {names}.", names=names)
         except RedisError as e:
             raise RedisClientError(str(e))
 
-    async def get_keys(self, pattern_name):
+    async def get_keys(self, pattern_name, count=500):
         """
         根据正则表达式获取redis的keys
+
+        使用SCAN游标分批遍历,避免KEYS在大键空间下长时间阻塞redis
         Args:
             pattern_name:正则表达式的名称
+            count: 每批扫描的key数量
         Returns:
 
         """
         try:
-            data = await self.redis_db.keys(pattern_name)
+            data, cursor = [], 0
+            while True:
+                cursor, batch = await self._scan(cursor=cursor, match=pattern_name, count=count)
+                data.extend(batch)
+                if cursor == 0:
+                    break
         except RedisError as e:
             raise RedisClientError(str(e))
         else: